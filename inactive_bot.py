@@ -3,7 +3,7 @@
 
 """
 Inactive Tracker Bot
-- Tracks member "interactions": messages, poll votes (bot-created polls), and reactions (if your PTB+Bot API expose them).
+- Tracks member "interactions": messages, poll votes (bot-created polls), and reactions (bot must be an admin).
 - Commands:
   /inactive <days>  — list users with no interactions in the last N days (default 30)
   /lastseen @user   — show last recorded interaction time for a member
@@ -12,35 +12,49 @@ Inactive Tracker Bot
   /help             — help
 Notes:
 - For reliable tracking, disable privacy mode in @BotFather or make the bot an admin so it can read group messages.
-- Persistence file defaults to /data/inactive_tracker.pkl (works great with a Railway volume mounted at /data).
+- Persistence is a SQLite database at PERSIST_FILE + ".db" (defaults to /data/inactive_tracker.pkl.db,
+  works great with a Railway volume mounted at /data). An existing pickle at PERSIST_FILE is imported once.
+- Changes are flushed every PERSIST_INTERVAL seconds (default 15) and on shutdown.
 """
 
 import os
 import io
 import csv
+import re
 import time
+import asyncio
+import functools
+import pickle
 import logging
+from array import array
+from bisect import bisect_left
+from collections import deque
 from datetime import datetime, timezone
-from typing import Dict, Set
+from typing import Any, AsyncIterator, Deque, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
 
+import aiosqlite
 from dotenv import load_dotenv
 
 from telegram import (
     Update,
+    User,
     ChatMember,
     ChatMemberUpdated,
-    Message,
 )
 from telegram.constants import ChatType, ParseMode
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BaseHandler,
     CommandHandler,
     MessageHandler,
     PollAnswerHandler,
     ChatMemberHandler,
+    MessageReactionHandler,
     CallbackContext,
     filters,
-    PicklePersistence,
+    BasePersistence,
+    PersistenceInput,
 )
 
 # -------------- Configuration --------------
@@ -51,6 +65,11 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 # Prefer Railway volume if available; overrideable via env.
 PERSIST_FILE = os.getenv("PERSIST_FILE", "/data/inactive_tracker.pkl")
 
+# Seconds between persistence flushes, i.e. how much activity a crash can lose.
+# A flush upserts only the rows queued since the last one; what still scales with users
+# is PTB's deepcopy of bot_data (~1.5 ms at 100k users, mostly the username dict).
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "15"))
+
 # Ensure parent dir exists (handles local runs too).
 try:
     os.makedirs(os.path.dirname(PERSIST_FILE), exist_ok=True)
@@ -65,8 +84,165 @@ logging.basicConfig(
 log = logging.getLogger("inactive-bot")
 
 # bot_data keys
-KEY_LAST_SEEN = "last_seen"   # dict[int user_id] -> float (unix ts)
+KEY_LAST_SEEN = "last_seen"   # LastSeenStore: user_id -> int (unix ts, rounded down to SEEN_RESOLUTION)
 KEY_GROUPS    = "groups"      # set[int chat_id] of groups we track
+KEY_USERNAME_INDEX = "uname_idx"  # UsernameIndex: str lowercase username -> int user_id
+
+# chat_data keys. chat_data is never persisted or copied (store_data.chat_data=False),
+# so it is the place for per-chat caches.
+CHAT_KEY_ADMINS = "admins"    # (fetched_ts, frozenset[int] non-bot admin ids)
+
+# Last-seen only needs minute precision; repeated activity within the same
+# bucket leaves bot_data untouched, so persistence has nothing to write.
+SEEN_RESOLUTION = 60
+
+# How long a chat's admin list is reused by /inactive before refetching (s).
+ADMIN_CACHE_TTL = 300
+
+# get_member lookups: max calls in flight at once, per-call timeout (s).
+LOOKUP_CONCURRENCY = 20
+LOOKUP_TIMEOUT = 10
+# How many lookups may be started ahead of the one being reported (streamed output).
+LOOKUP_AHEAD = 5 * LOOKUP_CONCURRENCY
+
+
+# Command argument validators: /inactive <days>, /lastseen <@username | user id>.
+# Days accept what int() did (a "+" sign, leading zeros), capped at 18 significant digits.
+_DAYS_RE = re.compile(r"\+?0*([1-9]\d{0,17})\Z")
+# 4-character usernames exist (collectible ones), so the lower bound is 4, not 5.
+_USERNAME_RE = re.compile(r"@?(?:(\d+)|([A-Za-z0-9_]{4,32}))\Z")
+
+# Chat types we track and answer /inactive in.
+_GROUP_TYPES = frozenset((ChatType.GROUP, ChatType.SUPERGROUP))
+_ADMIN_STATUSES = frozenset((ChatMember.ADMINISTRATOR, ChatMember.OWNER))
+
+
+# -------------- Storage --------------
+
+class _ChangeQueue:
+    """
+    Optional queue of changed entries, key -> new value, for the bot_data containers.
+    SQLitePersistence turns it on for the live containers and drains it on each flush,
+    so a flush only upserts what was written since the last one. Copies don't track.
+    """
+
+    __slots__ = ("changes",)
+
+    def __init__(self, track_changes: bool = False):
+        self.changes: Optional[Dict[Any, int]] = {} if track_changes else None
+
+    def pop_changes(self) -> List[Tuple[Any, int]]:
+        changes = self.changes
+        if not changes:
+            return []
+        self.changes = {}
+        return list(changes.items())
+
+    def requeue(self, changes: Iterable[Tuple[Any, int]]) -> None:
+        # A failed flush puts its rows back unless a newer write superseded them.
+        if self.changes is not None:
+            for key, value in changes:
+                self.changes.setdefault(key, value)
+
+
+class LastSeenStore(_ChangeQueue):
+    """
+    user_id -> last-seen timestamp as two parallel int64 arrays sorted by user_id.
+    ~16 bytes per user instead of a dict entry plus two boxed ints, and copying it
+    (PTB deep-copies bot_data on every persistence run) is a memcpy.
+    Exposes the subset of the dict API the handlers use.
+    """
+
+    __slots__ = ("uids", "ts")
+
+    def __init__(self, items: Iterable[Tuple[int, int]] = (), track_changes: bool = False):
+        super().__init__(track_changes)
+        self.uids = array("q")
+        self.ts = array("q")
+        for uid, ts in sorted(items):
+            self.uids.append(uid)
+            self.ts.append(int(ts))  # legacy pickles hold float seconds
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def __contains__(self, uid: int) -> bool:
+        return self.get(uid) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.uids)
+
+    def __getitem__(self, uid: int) -> int:
+        ts = self.get(uid)
+        if ts is None:
+            raise KeyError(uid)
+        return ts
+
+    def __setitem__(self, uid: int, ts: int) -> None:
+        uids = self.uids
+        i = bisect_left(uids, uid)
+        if i < len(uids) and uids[i] == uid:
+            self.ts[i] = ts
+        else:
+            # New users are rare next to updates; the memmove is fine.
+            uids.insert(i, uid)
+            self.ts.insert(i, ts)
+        if self.changes is not None:
+            self.changes[uid] = ts
+
+    def get(self, uid: int, default: Optional[int] = None) -> Optional[int]:
+        uids = self.uids
+        i = bisect_left(uids, uid)
+        if i < len(uids) and uids[i] == uid:
+            return self.ts[i]
+        return default
+
+    def keys(self) -> Iterator[int]:
+        return iter(self.uids)
+
+    def items(self) -> Iterator[Tuple[int, int]]:
+        return zip(self.uids, self.ts)
+
+    def copy(self) -> "LastSeenStore":
+        new = LastSeenStore.__new__(LastSeenStore)
+        new.uids = self.uids[:]
+        new.ts = self.ts[:]
+        new.changes = None
+        return new
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "LastSeenStore":
+        return self.copy()
+
+
+class UsernameIndex(_ChangeQueue):
+    """
+    lowercase username -> user_id. Only writes that change an entry are queued, and
+    deep copies are a plain dict copy.
+    """
+
+    __slots__ = ("names",)
+
+    def __init__(self, names: Optional[Dict[str, int]] = None, track_changes: bool = False):
+        super().__init__(track_changes)
+        self.names: Dict[str, int] = dict(names or {})
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        return self.names.get(key, default)
+
+    def __setitem__(self, key: str, uid: int) -> None:
+        if self.names.get(key) != uid:
+            self.names[key] = uid
+            if self.changes is not None:
+                self.changes[key] = uid
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "UsernameIndex":
+        new = UsernameIndex.__new__(UsernameIndex)
+        new.names = self.names.copy()
+        new.changes = None
+        return new
 
 
 # -------------- Helpers --------------
@@ -74,17 +250,18 @@ KEY_GROUPS    = "groups"      # set[int chat_id] of groups we track
 def now_ts() -> float:
     return time.time()
 
-def ensure_storage(context: CallbackContext) -> None:
-    bd = context.application.bot_data
+def ensure_storage(bd: Dict[str, Any]) -> None:
+    # Persistence fills these in; this covers a bot_data that didn't come from it.
     if KEY_LAST_SEEN not in bd:
-        bd[KEY_LAST_SEEN] = {}  # type: ignore[assignment]
+        bd[KEY_LAST_SEEN] = LastSeenStore()  # type: ignore[assignment]
     if KEY_GROUPS not in bd:
         bd[KEY_GROUPS] = set()  # type: ignore[assignment]
+    if KEY_USERNAME_INDEX not in bd:
+        bd[KEY_USERNAME_INDEX] = UsernameIndex()  # type: ignore[assignment]
 
-def touch_user(context: CallbackContext, user_id: int) -> None:
-    ensure_storage(context)
-    last_seen: Dict[int, float] = context.application.bot_data[KEY_LAST_SEEN]  # type: ignore[assignment]
-    last_seen[user_id] = now_ts()
+def index_username(index: UsernameIndex, user: User) -> None:
+    if user.username:
+        index[user.username.lower()] = user.id
 
 def fmt_user(user) -> str:
     name = (user.full_name or "").strip()
@@ -93,19 +270,263 @@ def fmt_user(user) -> str:
         return f"{name} ({tag})" if name else tag
     return name or f"ID:{user.id}"
 
-def human_dt(ts: float) -> str:
+@functools.lru_cache(maxsize=4096)
+def _fmt_ts(ts: int) -> str:
     dt = datetime.fromtimestamp(ts, tz=timezone.utc)
     return dt.astimezone().strftime("%Y-%m-%d %H:%M:%S %Z")
 
+def human_dt(ts: float) -> str:
+    # Timestamps are minute buckets, so many users share one formatted string.
+    return _fmt_ts(int(ts))
+
+def select_inactive(last_seen: LastSeenStore, admin_ids: Iterable[int], cutoff: float) -> List[int]:
+    # Single pass over the uid-sorted store, so the result is already in order; admins we
+    # never saw are inactive by definition, and only they can make a sort necessary.
+    uids = [uid for uid, ts in zip(last_seen.uids, last_seen.ts) if ts < cutoff]
+    unseen = [uid for uid in admin_ids if uid not in last_seen]
+    if unseen:
+        uids.extend(unseen)
+        uids.sort()
+    return uids
+
+async def _member_user(chat, uid: int) -> Optional[User]:
+    try:
+        cm = await asyncio.wait_for(chat.get_member(uid), timeout=LOOKUP_TIMEOUT)
+        return cm.user
+    except Exception:
+        return None
+
+async def iter_members(chat, uids: List[int]) -> AsyncIterator[Tuple[int, Optional[User]]]:
+    """
+    Resolve users with up to LOOKUP_CONCURRENCY get_member calls in flight, yielding in uid order.
+    Lookups are started up to LOOKUP_AHEAD uids ahead of the consumer, so a slow call only
+    holds back the yield, not the other slots. Callers should aclose() it when stopping early.
+    """
+    sem = asyncio.Semaphore(LOOKUP_CONCURRENCY)
+
+    async def fetch(uid: int) -> Optional[User]:
+        async with sem:
+            return await _member_user(chat, uid)
+
+    pending: Deque[Tuple[int, "asyncio.Task[Optional[User]]"]] = deque()
+    it = iter(uids)
+    try:
+        while True:
+            while len(pending) < LOOKUP_AHEAD:
+                uid = next(it, None)
+                if uid is None:
+                    break
+                pending.append((uid, asyncio.create_task(fetch(uid))))
+            if not pending:
+                return
+            uid, task = pending.popleft()
+            yield uid, await task
+    finally:
+        for _, task in pending:
+            task.cancel()
+
+async def find_uid_by_username(context: CallbackContext, chat, username: str) -> Optional[int]:
+    """
+    Slow path for /lastseen when the username index misses: ask Telegram about tracked
+    users through iter_members (LOOKUP_CONCURRENCY calls in flight, LOOKUP_AHEAD started
+    ahead). Every username seen on the way is indexed. Because of the read-ahead, a hit
+    can leave up to LOOKUP_AHEAD extra get_member calls started before the early return
+    cancels them.
+    """
+    wanted = username.lower()
+    bd = context.application.bot_data
+    index: UsernameIndex = bd[KEY_USERNAME_INDEX]  # type: ignore[assignment]
+    uids = list(bd[KEY_LAST_SEEN].keys())  # type: ignore[union-attr]
+    members = iter_members(chat, uids)
+    try:
+        async for _, user in members:
+            if user is None:
+                continue
+            index_username(index, user)
+            if user.username and user.username.lower() == wanted:
+                return user.id
+    finally:
+        await members.aclose()
+    return None
+
+
+# -------------- Persistence --------------
+
+class SQLitePersistence(BasePersistence):
+    """
+    Keeps bot_data in SQLite with one row per user/group.
+    Each flush only upserts rows that changed since the previous flush, instead of
+    re-pickling the whole dict like PicklePersistence does. The changes are drained
+    from the live containers handed out by get_bot_data, so a flush costs
+    O(changes); the deepcopy PTB passes to update_bot_data is not read.
+    Only KEY_LAST_SEEN, KEY_GROUPS and KEY_USERNAME_INDEX are stored; user/chat/callback data are unused.
+    """
+
+    def __init__(self, filepath: str, legacy_file: Optional[str] = None, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.filepath = filepath
+        self.legacy_file = legacy_file
+        self._db: Optional[aiosqlite.Connection] = None
+        # The live containers handed to the Application; flushes drain their queued changes.
+        self._last_seen = LastSeenStore(track_changes=True)
+        self._groups: Set[int] = set()
+        self._unames = UsernameIndex(track_changes=True)
+        # Groups already on disk (groups are few, and only ever added).
+        self._saved_groups: Set[int] = set()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        if self._db is None:
+            self._db = await aiosqlite.connect(self.filepath)
+            await self._db.executescript(
+                "PRAGMA journal_mode=WAL;"
+                "PRAGMA synchronous=NORMAL;"
+                "CREATE TABLE IF NOT EXISTS last_seen(uid INTEGER PRIMARY KEY, ts INTEGER);"
+                "CREATE TABLE IF NOT EXISTS groups(cid INTEGER PRIMARY KEY);"
+                "CREATE TABLE IF NOT EXISTS usernames(uname TEXT PRIMARY KEY, uid INTEGER);"
+            )
+        return self._db
+
+    def _load_legacy(self) -> Dict[str, Any]:
+        # PicklePersistence(single_file=True) stores {"bot_data": {...}, ...}.
+        # Failures abort startup: continuing empty would let the first flush make the
+        # database non-empty, and the import would never be attempted again.
+        try:
+            with open(self.legacy_file, "rb") as f:
+                return pickle.load(f).get("bot_data") or {}
+        except Exception as exc:
+            raise RuntimeError(
+                f"Could not import legacy pickle {self.legacy_file}; "
+                "repair it or move it away to start without the old data"
+            ) from exc
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        # If loading fails, PTB's shutdown() skips flush(), so close the connection here:
+        # aiosqlite's worker thread is not a daemon and would keep the process alive.
+        try:
+            return await self._load_bot_data()
+        except BaseException:
+            if self._db is not None:
+                await self._db.close()
+                self._db = None
+            raise
+
+    async def _load_bot_data(self) -> Dict[str, Any]:
+        db = await self._connect()
+        async with db.execute("SELECT uid, ts FROM last_seen") as cur:
+            last_seen = LastSeenStore(await cur.fetchall(), track_changes=True)
+        async with db.execute("SELECT cid FROM groups") as cur:
+            groups = {cid for (cid,) in await cur.fetchall()}
+        async with db.execute("SELECT uname, uid FROM usernames") as cur:
+            unames = UsernameIndex(dict(await cur.fetchall()), track_changes=True)
+
+        if not last_seen and not groups and self.legacy_file and os.path.exists(self.legacy_file):
+            legacy = self._load_legacy()
+            last_seen = LastSeenStore(legacy.get(KEY_LAST_SEEN, {}).items(), track_changes=True)
+            groups = set(legacy.get(KEY_GROUPS, set()))
+            await self._write(list(last_seen.items()), [(cid,) for cid in groups], [])
+            log.info("Imported %d users from legacy pickle %s", len(last_seen), self.legacy_file)
+
+        self._last_seen, self._groups, self._unames = last_seen, groups, unames
+        self._saved_groups = set(groups)
+        return {KEY_LAST_SEEN: last_seen, KEY_GROUPS: groups, KEY_USERNAME_INDEX: unames}
+
+    async def update_bot_data(self, data: Dict[str, Any]) -> None:
+        # `data` is PTB's deepcopy of bot_data; the live containers already know what changed.
+        groups = self._groups
+        # Groups are only ever added, so an unchanged size means nothing new.
+        new_groups = [(cid,) for cid in groups - self._saved_groups] if len(groups) != len(self._saved_groups) else []
+        changed = self._last_seen.pop_changes()
+        changed_unames = self._unames.pop_changes()
+        if not changed and not new_groups and not changed_unames:
+            return
+        try:
+            await self._write(changed, new_groups, changed_unames)
+        except Exception:
+            self._last_seen.requeue(changed)
+            self._unames.requeue(changed_unames)
+            raise
+        self._saved_groups.update(cid for (cid,) in new_groups)
+
+    async def _write(
+        self,
+        last_seen: List[Tuple[int, int]],
+        groups: List[Tuple[int]],
+        unames: List[Tuple[str, int]],
+    ) -> None:
+        db = await self._connect()
+        await db.executemany(
+            "INSERT INTO last_seen(uid, ts) VALUES(?, ?) "
+            "ON CONFLICT(uid) DO UPDATE SET ts=excluded.ts",
+            last_seen,
+        )
+        await db.executemany("INSERT OR IGNORE INTO groups(cid) VALUES(?)", groups)
+        await db.executemany(
+            "INSERT INTO usernames(uname, uid) VALUES(?, ?) "
+            "ON CONFLICT(uname) DO UPDATE SET uid=excluded.uid",
+            unames,
+        )
+        await db.commit()
+
+    async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._db is not None:
+            # Fold the WAL back into the main file so the next start reads one compact file.
+            await self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            await self._db.execute("PRAGMA optimize")
+            await self._db.close()
+            self._db = None
+
+    # Unused kinds of data (disabled via store_data).
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Any, Any]:
+        return {}
+
+    async def update_conversation(self, name: str, key: Any, new_state: Optional[object]) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
 
 # -------------- Command Handlers --------------
 
 async def cmd_start(update: Update, context: CallbackContext) -> None:
-    ensure_storage(context)
     await update.message.reply_text(
         "👋 I’m tracking member activity here.\n\n"
         "I mark interactions when someone sends a message, votes in a poll I create, "
-        "and (if supported) reacts to a message.\n\n"
+        "or reacts to a message (reactions only reach me if I’m an admin).\n\n"
         "Commands:\n"
         "• /inactive <days>\n"
         "• /lastseen @user\n"
@@ -124,19 +545,20 @@ async def cmd_help(update: Update, context: CallbackContext) -> None:
         "Tips:\n"
         "• Disable privacy mode or make me an admin so I can see messages.\n"
         "• I only receive poll votes for polls **I** create.\n"
-        "• Reactions require library/Bot API support.\n",
+        "• Telegram only sends me reactions if I’m an admin.\n",
         parse_mode=ParseMode.MARKDOWN
     )
 
 async def cmd_stats(update: Update, context: CallbackContext) -> None:
-    ensure_storage(context)
-    last_seen: Dict[int, float] = context.application.bot_data[KEY_LAST_SEEN]  # type: ignore[assignment]
+    last_seen: LastSeenStore = context.application.bot_data[KEY_LAST_SEEN]  # type: ignore[assignment]
     groups: Set[int] = context.application.bot_data[KEY_GROUPS]  # type: ignore[assignment]
     size_bytes = 0
-    try:
-        size_bytes = os.path.getsize(PERSIST_FILE)
-    except Exception:
-        pass
+    db_file = context.application.persistence.filepath  # type: ignore[union-attr]
+    for path in (db_file, db_file + "-wal"):
+        try:
+            size_bytes += os.path.getsize(path)
+        except Exception:
+            pass
     await update.message.reply_text(
         f"📊 Tracked users: {len(last_seen)}\n"
         f"🗂 Tracked groups: {len(groups)}\n"
@@ -144,105 +566,114 @@ async def cmd_stats(update: Update, context: CallbackContext) -> None:
     )
 
 async def cmd_export(update: Update, context: CallbackContext) -> None:
-    ensure_storage(context)
-    last_seen: Dict[int, float] = context.application.bot_data[KEY_LAST_SEEN]  # type: ignore[assignment]
-    buf = io.StringIO()
-    writer = csv.writer(buf)
+    last_seen: LastSeenStore = context.application.bot_data[KEY_LAST_SEEN]  # type: ignore[assignment]
+    # Encode straight into the upload buffer instead of StringIO -> str -> bytes.
+    raw = io.BytesIO()
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text)
     writer.writerow(["user_id", "last_interaction_iso"])
+    # Timestamps are whole seconds, so format from gmtime without building datetimes.
+    gmtime = time.gmtime
+    writerow = writer.writerow
     for uid, ts in last_seen.items():
-        writer.writerow([uid, datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()])
-    buf.seek(0)
+        t = gmtime(ts)
+        writerow((
+            uid,
+            f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}"
+            f"T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}+00:00",
+        ))
+    text.flush()
+    text.detach()  # so the wrapper doesn't close raw when it's collected
+    raw.seek(0)
     await update.message.reply_document(
-        document=io.BytesIO(buf.getvalue().encode("utf-8")),
+        document=raw,
         filename="inactive_last_seen.csv",
         caption="CSV export of last-interaction timestamps."
     )
 
 async def cmd_inactive(update: Update, context: CallbackContext) -> None:
-    ensure_storage(context)
     args = context.args or []
-    try:
-        days = int(args[0]) if args else 30
-        if days <= 0:
-            raise ValueError
-    except ValueError:
+    m = _DAYS_RE.match(args[0]) if args else None
+    if args and not m:
         await update.message.reply_text("Usage: /inactive <days>, e.g. /inactive 30")
         return
+    days = int(m.group(1)) if m else 30
 
     chat = update.effective_chat
-    if not chat or chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+    if not chat or chat.type not in _GROUP_TYPES:
         await update.message.reply_text("Run this in a group/supergroup.")
         return
 
-    cutoff = now_ts() - days * 86400
+    now = now_ts()
+    cutoff = now - days * 86400
     bd = context.application.bot_data
-    last_seen: Dict[int, float] = bd[KEY_LAST_SEEN]  # type: ignore[assignment]
+    last_seen: LastSeenStore = bd[KEY_LAST_SEEN]  # type: ignore[assignment]
 
     # Track this group
     groups: Set[int] = bd[KEY_GROUPS]  # type: ignore[assignment]
-    groups.add(chat.id)
+    if chat.id not in groups:
+        groups.add(chat.id)
 
     # We can’t enumerate all members via Bot API; we report among tracked users + admins.
-    try:
-        admins = await chat.get_administrators()
-        admin_ids = {adm.user.id for adm in admins if not adm.user.is_bot}
-    except Exception:
-        admin_ids = set()
-
-    candidate_ids = set(last_seen.keys()) | admin_ids
-
-    inactive_lines = []
-    for uid in sorted(candidate_ids):
-        ts = last_seen.get(uid, 0.0)
-        if ts < cutoff:
-            try:
-                cm = await chat.get_member(uid)
-                label = fmt_user(cm.user)
-            except Exception:
-                label = f"ID:{uid}"
-            seen_str = "never" if ts == 0 else human_dt(ts)
-            inactive_lines.append(f"• {label} — last seen: {seen_str}")
+    # Admin lists rarely change; reuse a recent one (on_chat_member drops it on role changes).
+    cached: Optional[Tuple[float, FrozenSet[int]]] = context.chat_data.get(CHAT_KEY_ADMINS)  # type: ignore[union-attr]
+    if cached and now - cached[0] < ADMIN_CACHE_TTL:
+        admin_ids = cached[1]
+    else:
+        try:
+            admins = await chat.get_administrators()
+            admin_ids = frozenset(adm.user.id for adm in admins if not adm.user.is_bot)
+            context.chat_data[CHAT_KEY_ADMINS] = (now, admin_ids)  # type: ignore[index]
+        except Exception:
+            admin_ids = frozenset()
 
-    if not inactive_lines:
+    inactive_uids = select_inactive(last_seen, admin_ids, cutoff)
+
+    if not inactive_uids:
         await update.message.reply_text(f"✅ No tracked members inactive for ≥ {days} days.")
         return
 
-    header = f"🚫 Inactive for ≥ {days} days (tracked users):"
-    chunk = [header]
-    total_len = len(header)
-    for line in inactive_lines:
-        if total_len + len(line) + 1 > 3500:
-            await update.message.reply_text("\n".join(chunk))
-            chunk = ["(cont’d)"]
-            total_len = len("(cont’d)")
-        chunk.append(line)
-        total_len += len(line) + 1
-    if chunk:
+    # Stream: each message goes out as soon as it is full, so only one chunk of lines is held.
+    chunk = [f"🚫 Inactive for ≥ {days} days (tracked users):"]
+    total_len = len(chunk[0])
+    members = iter_members(chat, inactive_uids)
+    try:
+        async for uid, user in members:
+            label = fmt_user(user) if user else f"ID:{uid}"
+            ts = last_seen.get(uid, 0)
+            seen_str = "never" if ts == 0 else human_dt(ts)
+            line = f"• {label} — last seen: {seen_str}"
+            add = len(line) + 1
+            if total_len + add > 3500:
+                await update.message.reply_text("\n".join(chunk))
+                chunk = ["(cont’d)"]
+                total_len = len("(cont’d)")
+            chunk.append(line)
+            total_len += add
+    finally:
+        await members.aclose()
+    if len(chunk) > 1:
         await update.message.reply_text("\n".join(chunk))
 
 async def cmd_lastseen(update: Update, context: CallbackContext) -> None:
-    ensure_storage(context)
-    if not context.args:
+    m = _USERNAME_RE.match(context.args[0]) if context.args else None
+    if not m:
+        # Also rejects things that can't be a Telegram username, before any lookup
         await update.message.reply_text("Usage: /lastseen @username or numeric user ID")
         return
 
-    target = context.args[0].lstrip("@")
+    uid_str, target = m.groups()
     chat = update.effective_chat
     user_id = None
 
-    if target.isdigit():
-        user_id = int(target)
+    if uid_str:
+        user_id = int(uid_str)
     else:
-        # Try to resolve from tracked users by username in this chat
-        last_seen: Dict[int, float] = context.application.bot_data[KEY_LAST_SEEN]  # type: ignore[assignment]
-        for uid in last_seen.keys():
-            try:
-                cm = await chat.get_member(uid)
-                if cm.user.username and cm.user.username.lower() == target.lower():
-                    user_id = uid
-                    break
-            except Exception:
-                continue
+        # Usernames are indexed as users interact; only ask Telegram on a miss
+        index: UsernameIndex = context.application.bot_data[KEY_USERNAME_INDEX]  # type: ignore[assignment]
+        user_id = index.get(target.lower())
+        if user_id is None:
+            user_id = await find_uid_by_username(context, chat, target)
 
     if not user_id:
         await update.message.reply_text("Couldn’t resolve that user in this chat (or not tracked yet).")
@@ -258,62 +689,109 @@ async def cmd_lastseen(update: Update, context: CallbackContext) -> None:
 
 # -------------- Update Handlers --------------
 
-async def on_message(update: Update, context: CallbackContext) -> None:
-    # Track any user message in groups/supergroups
-    chat = update.effective_chat
-    if not chat or chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
-        return
-    ensure_storage(context)
-    groups: Set[int] = context.application.bot_data[KEY_GROUPS]  # type: ignore[assignment]
-    groups.add(chat.id)
-
-    msg: Message = update.effective_message
-    if msg and msg.from_user and not msg.from_user.is_bot:
-        touch_user(context, msg.from_user.id)
-
-async def on_poll_answer(update: Update, context: CallbackContext) -> None:
-    # Fired when a user votes in a poll created by this bot
-    pa = update.poll_answer
-    if pa and pa.user and not pa.user.is_bot:
-        touch_user(context, pa.user.id)
-
-async def on_chat_member(update: Update, context: CallbackContext) -> None:
-    # When members join/leave/promote/demote
-    cmu: ChatMemberUpdated = update.chat_member
-    if not cmu:
-        return
-    ensure_storage(context)
-    groups: Set[int] = context.application.bot_data[KEY_GROUPS]  # type: ignore[assignment]
-    groups.add(cmu.chat.id)
-
-    after: ChatMember = cmu.new_chat_member
-    user = after.user
-    if user and not user.is_bot:
-        # Count (re)joining as an interaction (optional; comment out to disable)
-        if after.status in ("member", "administrator"):
-            touch_user(context, user.id)
-
-async def on_reaction(update: Update, context: CallbackContext) -> None:
+def tracking_handlers() -> List[BaseHandler]:
     """
-    Best-effort reaction handler.
-    Some PTB versions expose Update.message_reaction. If present, try to read user field.
-    If your PTB build doesn’t support reactions yet, this handler quietly does nothing.
+    Build the activity-tracking handlers. They run for nearly every update, so the
+    bot_data containers are captured on the first update instead of being looked up
+    per call, and recaptured only if the application's bot_data object is replaced.
     """
-    mr = getattr(update, "message_reaction", None)
-    if not mr:
-        return
-    user = getattr(mr, "user", None)
-    if user and not user.is_bot:
-        touch_user(context, user.id)
+    bound: Optional[Dict[str, Any]] = None
+    last_seen: LastSeenStore
+    groups: Set[int]
+    index: UsernameIndex
+
+    def bind(bd: Dict[str, Any]) -> None:
+        nonlocal bound, last_seen, groups, index
+        ensure_storage(bd)
+        last_seen, groups, index = bd[KEY_LAST_SEEN], bd[KEY_GROUPS], bd[KEY_USERNAME_INDEX]
+        bound = bd
+
+    def touch_user(user: User) -> None:
+        if user.username:
+            index[user.username.lower()] = user.id
+        ts = int(now_ts()) // SEEN_RESOLUTION * SEEN_RESOLUTION
+        if last_seen.get(user.id) != ts:
+            last_seen[user.id] = ts
+
+    async def on_message(update: Update, context: CallbackContext) -> None:
+        # Track any user message in groups/supergroups. Hot path: keep it lean, and
+        # reject bots/anonymous senders before touching bot_data at all.
+        msg = update.effective_message
+        if msg is None:
+            return
+        user = msg.from_user
+        if user is None or user.is_bot:
+            return
+        chat = update.effective_chat
+        if chat is None or chat.type not in _GROUP_TYPES:
+            return
+        if context.bot_data is not bound:
+            bind(context.bot_data)
+        # Steady state: the group is already known, so skip the set write entirely.
+        if chat.id not in groups:
+            groups.add(chat.id)
+        touch_user(user)
+
+    async def on_poll_answer(update: Update, context: CallbackContext) -> None:
+        # Fired when a user votes in a poll created by this bot
+        pa = update.poll_answer
+        if pa and pa.user and not pa.user.is_bot:
+            if context.bot_data is not bound:
+                bind(context.bot_data)
+            touch_user(pa.user)
+
+    async def on_chat_member(update: Update, context: CallbackContext) -> None:
+        # When members join/leave/promote/demote
+        cmu: ChatMemberUpdated = update.chat_member
+        if not cmu:
+            return
+        if context.bot_data is not bound:
+            bind(context.bot_data)
+        if cmu.chat.id not in groups:
+            groups.add(cmu.chat.id)
+
+        after: ChatMember = cmu.new_chat_member
+        if _ADMIN_STATUSES & {cmu.old_chat_member.status, after.status}:
+            # Promotion, demotion or an admin leaving: refetch admins on next /inactive
+            context.chat_data.pop(CHAT_KEY_ADMINS, None)  # type: ignore[union-attr]
+
+        user = after.user
+        if user and not user.is_bot:
+            # Count (re)joining as an interaction (optional; comment out to disable)
+            if after.status in ("member", "administrator"):
+                touch_user(user)
+
+    async def on_reaction(update: Update, context: CallbackContext) -> None:
+        # Reaction changes on a message (only delivered while the bot is an admin).
+        # Anonymous reactions (e.g. from channels) carry no user and are ignored.
+        mr = update.message_reaction
+        user = mr.user if mr else None
+        if user and not user.is_bot:
+            if context.bot_data is not bound:
+                bind(context.bot_data)
+            touch_user(user)
+
+    return [
+        # Track messages in groups
+        MessageHandler(filters.ChatType.GROUPS & ~filters.StatusUpdate.ALL, on_message),
+        # Poll votes (bot-created)
+        PollAnswerHandler(on_poll_answer),
+        # Member status updates
+        ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER),
+        # Reactions: a dedicated handler, so ordinary messages never reach it
+        MessageReactionHandler(
+            on_reaction, message_reaction_types=MessageReactionHandler.MESSAGE_REACTION_UPDATED
+        ),
+    ]
 
 
 # -------------- Main --------------
 
-def main():
-    if not BOT_TOKEN:
-        raise SystemExit("BOT_TOKEN missing. Set it in your Railway Variables or a local .env")
-
-    persistence = PicklePersistence(filepath=PERSIST_FILE)
+def build_app(persist_file: str) -> Application:
+    """The single place where the bot is wired up; main() only adds config and polling."""
+    persistence = SQLitePersistence(
+        filepath=persist_file + ".db", legacy_file=persist_file, update_interval=PERSIST_INTERVAL
+    )
     app = ApplicationBuilder().token(BOT_TOKEN).persistence(persistence).build()
 
     # Commands
@@ -324,19 +802,15 @@ def main():
     app.add_handler(CommandHandler("stats", cmd_stats))
     app.add_handler(CommandHandler("export", cmd_export))
 
-    # Track messages in groups
-    app.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.StatusUpdate.ALL, on_message))
-
-    # Poll votes (bot-created)
-    app.add_handler(PollAnswerHandler(on_poll_answer))
-
-    # Member status updates
-    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
+    # Tracking (after the commands, in the same group)
+    app.add_handlers(tracking_handlers())
+    return app
 
-    # Reactions: only meaningful if Update has the attribute in this PTB version
-    if hasattr(Update, "message_reaction"):
-        app.add_handler(MessageHandler(filters.ALL, on_reaction))
+def main():
+    if not BOT_TOKEN:
+        raise SystemExit("BOT_TOKEN missing. Set it in your Railway Variables or a local .env")
 
+    app = build_app(PERSIST_FILE)
     log.info("Starting bot…")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 